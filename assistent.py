@@ -1,13 +1,26 @@
 import os
+import asyncio
+import heapq
+import itertools
 import logging
-import json
+import mmap
+import sys
+import time
+import weakref
+import urllib.parse
+import orjson
 import shortuuid
+from cachetools import TTLCache
 from datetime import datetime
+from functools import lru_cache
+from typing import Optional
 from dotenv import load_dotenv
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
-import requests
+from telegram.error import BadRequest
+from telegram.ext import AIORateLimiter, Application, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
+import httpx
 from prompt_manager import PromptManager
+from note_manager import short_title
 
 # Logging configuration
 logging.basicConfig(
@@ -25,11 +38,36 @@ AUTHORIZED_USER_ID = int(os.getenv('AUTHORIZED_USER_ID'))
 OLLAMA_HOST = os.getenv('OLLAMA_HOST')
 BASE_DIR = os.getenv('BASE_DIR', os.path.join(os.path.dirname(__file__), 'data'))
 
+# Prefixes used to number notes, ideas and project notes
+ID_PREFIXES = ("projectnote", "note", "idea")
+
+# Seconds to wait after the last change before writing notes to disk
+FLUSH_DELAY = 2.0
+
+# Updates processed at the same time; those of a single user still run one after another
+MAX_CONCURRENT_UPDATES = 30
+
 # Lista de usuarios autorizados
 ALLOWED_USERS = [AUTHORIZED_USER_ID]
 
 # Global variables for user states
-user_states = {}  # Dictionary to store each user's state
+# Each user's state, dropped after an hour without changes so idle conversations don't pile up
+user_states = TTLCache(maxsize=10_000, ttl=3600)
+
+# HTTP client shared by every Ollama request, created on first use
+_http_client: Optional[httpx.AsyncClient] = None
+
+# Prompt manager and current base prompt, loaded on first use
+_prompt_manager: Optional[PromptManager] = None
+_prompt_cache: Optional[dict] = None
+
+def now_iso() -> str:
+    """Gets the current local time as an ISO 8601 string"""
+    return datetime.now().isoformat()
+
+def is_valid_project_name(name: str) -> bool:
+    """Checks that a project name stays a single directory inside the projects folder"""
+    return name not in ("", ".", "..") and not any(char in name for char in ("/", "\\", "\0"))
 
 class NoteManager:
     """Manager for notes and projects"""
@@ -41,26 +79,74 @@ class NoteManager:
         self.projects_dir = os.path.join(base_dir, "projects")
         self.refined_dir = os.path.join(base_dir, "refined")
         
+        # Notes are stored in JSON Lines shards: one for notes without a project
+        # and one per project, in data/projects/<project>/notes.jsonl
+        self.global_notes_file = os.path.join(self.notes_dir, "_global.jsonl")
+        self.legacy_notes_file = os.path.join(base_dir, "notes.json")
+        
         # JSON files for storing metadata
-        self.notes_file = os.path.join(base_dir, "notes.json")
         self.projects_file = os.path.join(base_dir, "projects.json")
-        self.refined_file = os.path.join(base_dir, "refined.json")
+        # Refined versions are only ever appended, one JSON record per line
+        self.refined_file = os.path.join(base_dir, "refined.jsonl")
+        self.legacy_refined_file = os.path.join(base_dir, "refined.json")
         
         # Ensure necessary directories exist
         self._ensure_directories()
         
         # Initialize JSON files if they don't exist
-        if not os.path.exists(self.notes_file):
-            with open(self.notes_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
-                
+        if not os.path.exists(self.global_notes_file):
+            open(self.global_notes_file, 'wb').close()
+        
         if not os.path.exists(self.projects_file):
-            with open(self.projects_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+            with open(self.projects_file, 'wb') as f:
+                f.write(orjson.dumps([]))
                 
         if not os.path.exists(self.refined_file):
-            with open(self.refined_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+            self._migrate_refined()
+        
+        # Load everything once; from here on the in-memory data is the source of truth
+        self._projects = self._load_json(self.projects_file)
+        self._projects_index = {project["id"]: project for project in self._projects}
+        
+        # Notes of each shard in creation order, keyed by project ID (None for no project)
+        self._shards = self._load_shards()
+        self._notes_index = {}
+        for notes in self._shards.values():
+            for note in notes:
+                self._notes_index[note["id"]] = note
+                # Notes saved before titles were stored get one in memory
+                note.setdefault("title", short_title(note["content"]))
+        
+        # First refined version of each note
+        self._refined_index = {}
+        for record in self._load_jsonl(self.refined_file):
+            self._refined_index.setdefault(record["id"], record)
+        
+        # Pending changes, written together shortly after the last change
+        self._dirty = {"projects": False}
+        self._dirty_shards = set()
+        self._pending_notes = {}
+        self._pending_refined = []
+        self._flush_handle = None
+        self._flush_task = None
+        
+        # Disk writes run in a worker thread, one batch at a time
+        self._write_lock = asyncio.Lock()
+        
+        if os.path.exists(self.legacy_notes_file):
+            self._migrate_notes()
+        
+        # Highest numeric ID per prefix, so new IDs don't need a scan
+        self._next_id = {prefix: 0 for prefix in ID_PREFIXES}
+        for note_id in self._notes_index:
+            for prefix in ID_PREFIXES:
+                if note_id.startswith(prefix):
+                    try:
+                        num = int(note_id[len(prefix):])
+                        self._next_id[prefix] = max(self._next_id[prefix], num)
+                    except ValueError:
+                        pass
+                    break
     
     def _ensure_directories(self):
         """Ensures that necessary directories exist"""
@@ -71,41 +157,204 @@ class NoteManager:
     def _load_json(self, file_path: str):
         """Loads data from a JSON file"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(file_path, 'rb') as f:
+                # mmap refuses empty files, and an empty file holds no records anyway
+                if os.fstat(f.fileno()).st_size == 0:
+                    return []
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+                    return orjson.loads(view)
         except Exception as e:
             logger.error(f"Error loading {file_path}: {str(e)}")
             return []
     
-    def _save_json(self, file_path: str, data):
-        """Saves data to a JSON file"""
+    def _load_jsonl(self, file_path: str):
+        """Loads the records of a JSON Lines file"""
+        records = []
         try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            with open(file_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    return records
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for line in iter(mm.readline, b""):
+                        if line.strip():
+                            records.append(orjson.loads(line))
+        except Exception as e:
+            logger.error(f"Error loading {file_path}: {str(e)}")
+        return records
+    
+    def _dump_jsonl(self, records) -> bytes:
+        """Serializes records as JSON Lines"""
+        return b"".join(orjson.dumps(record) + b"\n" for record in records)
+    
+    def _replace_file(self, file_path: str, payload: bytes) -> bool:
+        """Replaces the content of a file"""
+        # Write next to the target and swap it in, so a crash never leaves a half-written file
+        tmp_path = file_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, file_path)
             return True
         except Exception as e:
             logger.error(f"Error saving to {file_path}: {str(e)}")
             return False
     
-    def _get_next_id(self, prefix, notes):
-        """Gets the next ID for a note type"""
-        # Find the highest current ID
-        max_id = 0
-        for note in notes:
-            if note["id"].startswith(prefix):
-                try:
-                    num = int(note["id"][len(prefix):])
-                    max_id = max(max_id, num)
-                except ValueError:
-                    pass
+    def _append_file(self, file_path: str, payload: bytes) -> bool:
+        """Appends data to the end of a file"""
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(file_path, 'ab') as f:
+                f.write(payload)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving to {file_path}: {str(e)}")
+            return False
+    
+    def _project_dir(self, project_id: str) -> str:
+        """Gets the directory of a project"""
+        # Older projects may have names like 'a/b' or '..', so the ID is encoded into a single path component
+        return os.path.join(self.projects_dir, urllib.parse.quote(project_id, safe='').replace('.', '%2E'))
+    
+    def _shard_file(self, project_id=None) -> str:
+        """Gets the path of the shard holding the notes of a project"""
+        if project_id:
+            return os.path.join(self._project_dir(project_id), "notes.jsonl")
+        return self.global_notes_file
+    
+    def _load_shards(self):
+        """Loads the global shard and the shard of every project"""
+        shards = {None: self._load_jsonl(self.global_notes_file)}
+        
+        for entry in os.listdir(self.projects_dir):
+            shard_file = os.path.join(self.projects_dir, entry, "notes.jsonl")
+            if os.path.isfile(shard_file):
+                for note in self._load_jsonl(shard_file):
+                    shards.setdefault(note.get("project_id"), []).append(note)
+        
+        return shards
+    
+    def _migrate_notes(self):
+        """Moves the notes of the old notes.json into the shards"""
+        migrated = set()
+        for note in self._load_json(self.legacy_notes_file):
+            migrated.add(note["id"])
+            if note["id"] not in self._notes_index:
+                note.setdefault("title", short_title(note["content"]))
+                shard = note.get("project_id")
+                self._shards.setdefault(shard, []).append(note)
+                self._notes_index[note["id"]] = note
+                self._dirty_shards.add(shard)
         
-        # Return the next ID
-        return f"{prefix}{max_id + 1}"
+        # Only drop the old file once every shard has been written and reads back all its notes
+        if all(self._write_files(self._collect_writes())):
+            stored = {note["id"] for notes in self._load_shards().values() for note in notes}
+            if migrated <= stored:
+                os.remove(self.legacy_notes_file)
+            else:
+                logger.error(f"Keeping {self.legacy_notes_file}: some of its notes could not be read back")
+    
+    def _migrate_refined(self):
+        """Creates refined.jsonl, moving over the records of the old refined.json"""
+        records = []
+        if os.path.exists(self.legacy_refined_file):
+            records = self._load_json(self.legacy_refined_file)
+        
+        with open(self.refined_file, 'wb') as f:
+            f.write(self._dump_jsonl(records))
+        
+        if os.path.exists(self.legacy_refined_file):
+            os.remove(self.legacy_refined_file)
+    
+    def _mark_dirty(self, name: str):
+        """Marks a file as modified and schedules a debounced flush"""
+        self._dirty[name] = True
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """Schedules a write of the pending changes"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. used from a script): write right away
+            self.flush()
+            return
+        
+        # Restart the timer so a burst of edits ends up in a single write
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+        self._flush_handle = loop.call_later(FLUSH_DELAY, self._start_flush)
+    
+    def _start_flush(self):
+        """Starts the background flush once the debounce timer fires"""
+        self._flush_handle = None
+        self._flush_task = asyncio.get_running_loop().create_task(self.flush_async())
+    
+    def _collect_writes(self):
+        """Serializes the pending changes into a list of (path, payload, append) writes"""
+        writes = []
+        
+        if self._dirty["projects"]:
+            self._dirty["projects"] = False
+            payload = orjson.dumps(self._projects, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+            writes.append((self.projects_file, payload, False))
+        
+        # Rewritten shards already contain their pending notes
+        dirty_shards, self._dirty_shards = self._dirty_shards, set()
+        pending_notes, self._pending_notes = self._pending_notes, {}
+        for shard in dirty_shards:
+            writes.append((self._shard_file(shard), self._dump_jsonl(self._shards.get(shard, [])), False))
+        for shard, notes in pending_notes.items():
+            if shard not in dirty_shards:
+                writes.append((self._shard_file(shard), self._dump_jsonl(notes), True))
+        
+        if self._pending_refined:
+            pending_refined, self._pending_refined = self._pending_refined, []
+            writes.append((self.refined_file, self._dump_jsonl(pending_refined), True))
+        
+        return writes
+    
+    def _write_files(self, writes):
+        """Performs the writes prepared by _collect_writes"""
+        results = []
+        for file_path, payload, append in writes:
+            if append:
+                results.append(self._append_file(file_path, payload))
+            else:
+                results.append(self._replace_file(file_path, payload))
+        return results
+    
+    async def flush_async(self):
+        """Writes the pending changes from a worker thread"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        
+        async with self._write_lock:
+            # Serialize on the event loop so the data can't change while it's being dumped
+            writes = self._collect_writes()
+            await asyncio.to_thread(self._write_files, writes)
+    
+    def flush(self):
+        """Writes every pending change to disk"""
+        self._write_files(self._collect_writes())
+    
+    def _get_next_id(self, prefix):
+        """Gets the next ID for a note type"""
+        next_id = self._next_id[prefix] + 1
+        self._next_id[prefix] = next_id
+        return f"{prefix}{next_id}"
+    
+    def _add_note(self, note):
+        """Adds a new note to its shard and schedules appending it to disk"""
+        shard = note.get("project_id")
+        self._shards.setdefault(shard, []).append(note)
+        self._notes_index[note["id"]] = note
+        self._pending_notes.setdefault(shard, []).append(note)
+        self._schedule_flush()
     
     def create_note(self, content: str, project_id=None):
         """Creates a new note"""
-        notes = self._load_json(self.notes_file)
-        
         # Determine the prefix based on the note type
         if project_id:
             prefix = "projectnote"
@@ -113,185 +362,184 @@ class NoteManager:
             prefix = "note"
         
         # Get the next ID
-        note_id = self._get_next_id(prefix, notes)
+        note_id = self._get_next_id(prefix)
         
         note = {
             "id": note_id,
             "content": content,
-            "created": datetime.now().isoformat(),
+            "title": short_title(content),
+            "created": now_iso(),
             "project_id": project_id
         }
         
-        notes.append(note)
-        self._save_json(self.notes_file, notes)
+        self._add_note(note)
         
         return note
     
     def create_idea(self, content: str):
         """Creates a new idea"""
-        notes = self._load_json(self.notes_file)
-        
         # Get the next ID for ideas
-        idea_id = self._get_next_id("idea", notes)
+        idea_id = self._get_next_id("idea")
         
         idea = {
             "id": idea_id,
             "content": content,
-            "created": datetime.now().isoformat(),
+            "title": short_title(content),
+            "created": now_iso(),
             "type": "idea"
         }
         
-        notes.append(idea)
-        self._save_json(self.notes_file, notes)
+        self._add_note(idea)
         
         return idea
     
     def get_note(self, note_id: str):
         """Gets a note by its ID"""
-        notes = self._load_json(self.notes_file)
-        for note in notes:
-            if note["id"] == note_id:
-                return note
-        return None
+        return self._notes_index.get(note_id)
     
     def get_recent_notes(self, limit=10):
         """Gets the most recent notes"""
-        notes = self._load_json(self.notes_file)
-        notes.sort(key=lambda x: x["created"], reverse=True)
-        return notes[:limit]
+        # Only the newest notes across all shards are needed, no full sort
+        all_notes = itertools.chain.from_iterable(self._shards.values())
+        return heapq.nlargest(limit, all_notes, key=lambda x: x["created"])
     
     def create_project(self, title: str):
-        """Creates a new project"""
-        projects = self._load_json(self.projects_file)
-        
-        # Use the title as the project ID
+        """Creates a new project; returns None if the title can't name its directory"""
+        # Use the title as the project ID, which is also the name of its notes directory
+        if not is_valid_project_name(title):
+            return None
         project_id = title
         
         # Check if a project with that name already exists
-        for project in projects:
-            if project["id"] == project_id:
-                return project
+        existing = self._projects_index.get(project_id)
+        if existing:
+            return existing
         
         project = {
             "id": project_id,
             "title": title,
-            "created": datetime.now().isoformat()
+            "created": now_iso()
         }
         
         # Create directory for the project
-        project_dir = os.path.join(self.projects_dir, project["id"])
-        os.makedirs(project_dir, exist_ok=True)
+        os.makedirs(self._project_dir(project["id"]), exist_ok=True)
         
-        projects.append(project)
-        self._save_json(self.projects_file, projects)
+        self._projects.append(project)
+        self._projects_index[project_id] = project
+        self._mark_dirty("projects")
         
         return project
     
     def get_project(self, project_id: str):
         """Gets a project by its ID (name)"""
-        projects = self._load_json(self.projects_file)
-        for project in projects:
-            if project["id"] == project_id:
-                return project
-        return None
+        return self._projects_index.get(project_id)
     
     def get_projects(self):
-        """Gets all projects"""
-        return self._load_json(self.projects_file)
+        """Gets all projects (the in-memory list itself, already updated by create_project)"""
+        return self._projects
     
     def get_notes_by_project(self, project_id: str):
         """Gets all notes of a project"""
-        notes = self._load_json(self.notes_file)
-        return [note for note in notes if note.get("project_id") == project_id]
+        return self._shards.get(project_id, [])
 
     def update_note(self, note_id: str, content: str) -> bool:
         """Updates the content of a note and saves the refined version"""
-        notes = self._load_json(self.notes_file)
-        refined_notes = self._load_json(self.refined_file)
-        
-        # Find the original note
-        original_note = None
-        for note in notes:
-            if note["id"] == note_id:
-                original_note = note
-                break
+        original_note = self._notes_index.get(note_id)
         
         if original_note:
+            now = now_iso()
+            
             # Create the refined version
             refined_note = {
                 "id": note_id,
                 "original_content": original_note["content"],
                 "refined_content": content,
-                "created": datetime.now().isoformat(),
+                "created": now,
                 "project_id": original_note.get("project_id")
             }
             
             # Save the refined version
-            refined_notes.append(refined_note)
-            self._save_json(self.refined_file, refined_notes)
+            self._pending_refined.append(refined_note)
+            self._refined_index.setdefault(note_id, refined_note)
             
-            # Update the original note
+            # Update the original note; only its shard needs rewriting
             original_note["content"] = content
-            original_note["updated"] = datetime.now().isoformat()
-            self._save_json(self.notes_file, notes)
+            original_note["title"] = short_title(content)
+            original_note["updated"] = now
+            self._dirty_shards.add(original_note.get("project_id"))
+            self._schedule_flush()
             
             return True
         return False
     
     def get_refined_note(self, note_id: str):
         """Gets the refined version of a note by its ID"""
-        refined_notes = self._load_json(self.refined_file)
-        for note in refined_notes:
-            if note["id"] == note_id:
-                return note
-        return None
+        return self._refined_index.get(note_id)
 
 # Initialize the note manager
 note_manager = NoteManager()
 
+# Static keyboards, built once since markups are immutable and can be shared
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Nueva nota", callback_data="new_note")],
+    [InlineKeyboardButton("💡 Nueva idea", callback_data="new_idea")],
+    [InlineKeyboardButton("📋 Proyectos", callback_data="menu_projects")],
+    [InlineKeyboardButton("🔍 Refinar texto", callback_data="refine_message")],
+    [InlineKeyboardButton("🤖 Prompt base", callback_data="base_prompt")],
+    [InlineKeyboardButton("❓ Ayuda", callback_data="help")]
+])
+
+CANCEL_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Cancelar", callback_data="cancel")]
+])
+
+BASE_PROMPT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Editar prompt", callback_data="edit_base_prompt")],
+    [InlineKeyboardButton("🔙 Menú principal", callback_data="menu_main")]
+])
+
+HELP_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Ayuda sobre notas", callback_data="help_notes")],
+    [InlineKeyboardButton("💡 Ayuda sobre ideas", callback_data="help_ideas")],
+    [InlineKeyboardButton("📋 Ayuda sobre proyectos", callback_data="help_projects")],
+    [InlineKeyboardButton("🔍 Ayuda sobre refinamiento", callback_data="help_refine")],
+    [InlineKeyboardButton("🔙 Menú principal", callback_data="menu_main")]
+])
+
+CONFIRMATION_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✅ Confirm", callback_data="confirm")],
+    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+])
+
 class InterfaceGenerator:
     """Clase para generar interfaces de usuario"""
     
     @staticmethod
     def create_main_menu():
         """Creates the main menu"""
-        keyboard = [
-            [InlineKeyboardButton("📝 Nueva nota", callback_data="new_note")],
-            [InlineKeyboardButton("💡 Nueva idea", callback_data="new_idea")],
-            [InlineKeyboardButton("📋 Proyectos", callback_data="menu_projects")],
-            [InlineKeyboardButton("🔍 Refinar texto", callback_data="refine_message")],
-            [InlineKeyboardButton("🤖 Prompt base", callback_data="base_prompt")],
-            [InlineKeyboardButton("❓ Ayuda", callback_data="help")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return MAIN_MENU_MARKUP
     
     @staticmethod
     def create_cancel_menu():
         """Creates the cancel menu"""
-        keyboard = [
-            [InlineKeyboardButton("❌ Cancelar", callback_data="cancel")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return CANCEL_MENU_MARKUP
     
     @staticmethod
     def create_base_prompt_menu(prompt_content):
         """Creates the menu to view and edit the base prompt"""
-        keyboard = [
-            [InlineKeyboardButton("✏️ Editar prompt", callback_data="edit_base_prompt")],
-            [InlineKeyboardButton("🔙 Menú principal", callback_data="menu_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return BASE_PROMPT_MENU_MARKUP
+    
+    @staticmethod
+    @lru_cache(maxsize=1024)
+    def create_note_button(note_id, icon, title):
+        """Creates the button that opens a note; reused while its title doesn't change"""
+        return InlineKeyboardButton(f"{icon} {note_id} - {title}", callback_data=f"note_{note_id}")
     
     @staticmethod
     def create_notes_menu(notes):
         """Crea el menú de notas"""
-        keyboard = []
-        
-        # Agregar botones para cada nota
+        entries = []
         for note in notes:
-            # Crear un título corto para la nota (primeros 30 caracteres)
-            title = note['content'][:30] + "..." if len(note['content']) > 30 else note['content']
-            
             # Determinar el tipo de nota para mostrar el icono correcto
             icon = "📝"
             if note.get("type") == "idea":
@@ -299,7 +547,15 @@ class InterfaceGenerator:
             elif note.get("project_id"):
                 icon = "📋"
             
-            keyboard.append([InlineKeyboardButton(f"{icon} {note['id']} - {title}", callback_data=f"note_{note['id']}")])
+            entries.append((note['id'], icon, note['title']))
+        
+        return InterfaceGenerator._build_notes_menu(tuple(entries))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _build_notes_menu(entries):
+        """Builds the notes menu; reused while the listed notes don't change"""
+        keyboard = [[InterfaceGenerator.create_note_button(*entry)] for entry in entries]
         
         # Agregar botones de acción
         keyboard.append([InlineKeyboardButton("➕ Nueva nota", callback_data="new_note")])
@@ -310,11 +566,17 @@ class InterfaceGenerator:
     @staticmethod
     def create_projects_menu(projects):
         """Crea el menú de proyectos"""
-        keyboard = []
-        
+        return InterfaceGenerator._build_projects_menu(tuple((project['id'], project['title']) for project in projects))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _build_projects_menu(entries):
+        """Builds the projects menu; reused while the projects don't change"""
         # Agregar botones para cada proyecto
-        for project in projects:
-            keyboard.append([InlineKeyboardButton(f"📋 {project['title']}", callback_data=f"project_{project['id']}")])
+        keyboard = [
+            [InlineKeyboardButton(f"📋 {title}", callback_data=f"project_{project_id}")]
+            for project_id, title in entries
+        ]
         
         # Agregar botones de acción
         keyboard.append([InlineKeyboardButton("➕ Nuevo proyecto", callback_data="new_project")])
@@ -325,16 +587,10 @@ class InterfaceGenerator:
     @staticmethod
     def create_help_menu():
         """Crea el menú de ayuda"""
-        keyboard = [
-            [InlineKeyboardButton("📝 Ayuda sobre notas", callback_data="help_notes")],
-            [InlineKeyboardButton("💡 Ayuda sobre ideas", callback_data="help_ideas")],
-            [InlineKeyboardButton("📋 Ayuda sobre proyectos", callback_data="help_projects")],
-            [InlineKeyboardButton("🔍 Ayuda sobre refinamiento", callback_data="help_refine")],
-            [InlineKeyboardButton("🔙 Menú principal", callback_data="menu_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return HELP_MENU_MARKUP
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def create_note_buttons(note_id):
         """Crea los botones para una nota"""
         keyboard = [
@@ -344,6 +600,7 @@ class InterfaceGenerator:
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def create_project_buttons(project_id):
         """Crea los botones para un proyecto"""
         keyboard = [
@@ -356,11 +613,7 @@ class InterfaceGenerator:
     @staticmethod
     def create_confirmation_buttons():
         """Creates confirmation buttons"""
-        keyboard = [
-            [InlineKeyboardButton("✅ Confirm", callback_data="confirm")],
-            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return CONFIRMATION_MARKUP
     
     @staticmethod
     def format_note_message(note):
@@ -382,8 +635,7 @@ class InterfaceGenerator:
         if notes:
             message += "Notas del proyecto:\n\n"
             for note in notes:
-                title = note['content'][:30] + "..." if len(note['content']) > 30 else note['content']
-                message += f"• {note['id']} - {title}\n"
+                message += f"• {note['id']} - {note['title']}\n"
         
         return message
 
@@ -394,21 +646,44 @@ def is_authorized(user_id: int) -> bool:
     """Checks if a user is authorized to use the bot"""
     return user_id == AUTHORIZED_USER_ID
 
+# Common words in English and Spanish for better detection
+ENGLISH_WORDS = frozenset({'the', 'and', 'is', 'are', 'was', 'were', 'have', 'has', 'had', 'this', 'that', 'these', 'those', 'what', 'when', 'where', 'why', 'how', 'who', 'which'})
+SPANISH_WORDS = frozenset({'el', 'la', 'los', 'las', 'es', 'son', 'está', 'están', 'tiene', 'tienen', 'este', 'esta', 'estos', 'estas', 'qué', 'cuándo', 'dónde', 'por qué', 'cómo', 'quién'})
+
+# Only the first words are needed to tell the languages apart
+LANGUAGE_SAMPLE_WORDS = 200
+
 def is_english(text: str) -> bool:
     """Detects if text is in English or Spanish"""
-    # Common words in English and Spanish for better detection
-    english_words = {'the', 'and', 'is', 'are', 'was', 'were', 'have', 'has', 'had', 'this', 'that', 'these', 'those', 'what', 'when', 'where', 'why', 'how', 'who', 'which'}
-    spanish_words = {'el', 'la', 'los', 'las', 'es', 'son', 'está', 'están', 'tiene', 'tienen', 'este', 'esta', 'estos', 'estas', 'qué', 'cuándo', 'dónde', 'por qué', 'cómo', 'quién'}
-    
-    # Convert text to lowercase and split into words
-    words = text.lower().split()
-    
-    # Count words in English and Spanish
-    english_count = sum(1 for word in words if word in english_words)
-    spanish_count = sum(1 for word in words if word in spanish_words)
+    # Distinct lowercase words from the beginning of the text
+    words = set(text.lower().split(None, LANGUAGE_SAMPLE_WORDS)[:LANGUAGE_SAMPLE_WORDS])
     
     # If there are more English words than Spanish words, we consider it English
-    return english_count > spanish_count
+    return len(words & ENGLISH_WORDS) > len(words & SPANISH_WORDS)
+
+# Texts shown by /start and by the help menu
+WELCOME_TEXT = (
+    "👋 ¡Bienvenido al Asistente de Notas!\n\n"
+    "Este bot te ayuda a organizar tus notas y proyectos.\n\n"
+    "Puedes:\n"
+    "• Crear nuevas notas\n"
+    "💡 Guardar ideas\n"
+    "📋 Organizar proyectos\n"
+    "🔍 Refinar textos\n"
+    "🤖 Ver y editar el prompt base de la IA\n"
+    "❓ Obtener ayuda\n\n"
+    "¿Qué te gustaría hacer?"
+)
+
+HELP_MENU_TEXT = (
+    "❓ ¿Con qué necesitas ayuda?\n\n"
+    "Puedo ayudarte con:\n"
+    "• Cómo guardar y organizar notas\n"
+    "• Cómo guardar ideas\n"
+    "• Cómo crear y gestionar proyectos\n"
+    "• Cómo refinar textos con IA\n\n"
+    "Selecciona una opción para ver más detalles:"
+)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el comando /start"""
@@ -416,19 +691,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Lo siento, no tienes permiso para usar este bot.")
         return
 
-    welcome_message = (
-        "👋 ¡Bienvenido al Asistente de Notas!\n\n"
-        "Este bot te ayuda a organizar tus notas y proyectos.\n\n"
-        "Puedes:\n"
-        "• Crear nuevas notas\n"
-        "💡 Guardar ideas\n"
-        "📋 Organizar proyectos\n"
-        "🔍 Refinar textos\n"
-        "🤖 Ver y editar el prompt base de la IA\n"
-        "❓ Obtener ayuda\n\n"
-        "¿Qué te gustaría hacer?"
-    )
-    await update.message.reply_text(welcome_message, reply_markup=InterfaceGenerator.create_main_menu())
+    # Starting over abandons a base prompt edit that was never sent
+    context.user_data.pop('waiting_for_base_prompt', None)
+    await update.message.reply_text(WELCOME_TEXT, reply_markup=InterfaceGenerator.create_main_menu())
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Maneja el comando /help"""
@@ -436,18 +701,8 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("Lo siento, no tienes permiso para usar este bot.")
         return
 
-    help_text = (
-        "❓ ¿Con qué necesitas ayuda?\n\n"
-        "Puedo ayudarte con:\n"
-        "• Cómo guardar y organizar notas\n"
-        "• Cómo guardar ideas\n"
-        "• Cómo crear y gestionar proyectos\n"
-        "• Cómo refinar textos con IA\n\n"
-        "Selecciona una opción para ver más detalles:"
-    )
-
     await update.message.reply_text(
-        text=help_text,
+        text=HELP_MENU_TEXT,
         reply_markup=interface.create_help_menu()
     )
 
@@ -457,386 +712,682 @@ async def menu_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("You're not authorized to use this bot.")
         return
     
+    context.user_data.pop('waiting_for_base_prompt', None)
     await update.message.reply_text(
         "Select an option:",
         reply_markup=interface.create_main_menu()
     )
 
+# Help texts for each help_<type> button
+HELP_TEXTS = {
+    "notes": (
+        "📝 Ayuda sobre notas\n\n"
+        "Las notas te permiten guardar información importante para referencia posterior.\n\n"
+        "Para crear una nota:\n"
+        "1. Selecciona '📝 Nueva nota' del menú principal\n"
+        "2. Escribe el contenido de tu nota\n"
+        "3. La nota se guardará automáticamente\n\n"
+        "Para ver tus notas:\n"
+        "1. Selecciona '📝 Nueva nota' del menú principal\n"
+        "2. Verás una lista de tus notas más recientes\n"
+        "3. Selecciona una nota para ver su contenido\n\n"
+        "También puedes refinar una nota existente para mejorar su presentación."
+    ),
+    "ideas": (
+        "💡 Ayuda sobre ideas\n\n"
+        "Las ideas te permiten guardar pensamientos o conceptos que quieres desarrollar más tarde.\n\n"
+        "Para guardar una idea:\n"
+        "1. Selecciona '💡 Nueva idea' del menú principal\n"
+        "2. Escribe tu idea\n"
+        "3. La idea se guardará automáticamente\n\n"
+        "Las ideas son similares a las notas, pero están diseñadas para conceptos más breves o en desarrollo."
+    ),
+    "projects": (
+        "📋 Ayuda sobre proyectos\n\n"
+        "Los proyectos son carpetas donde puedes organizar tus notas por tema.\n\n"
+        "Para crear un proyecto:\n"
+        "1. Selecciona '📋 Proyectos' del menú principal\n"
+        "2. Selecciona '➕ Nuevo proyecto'\n"
+        "3. Escribe el nombre del proyecto\n\n"
+        "Para agregar una nota a un proyecto:\n"
+        "1. Selecciona un proyecto de la lista\n"
+        "2. Selecciona '➕ Nueva nota'\n"
+        "3. Escribe el contenido de tu nota\n\n"
+        "También puedes preguntar a la IA sobre un proyecto para obtener información basada en todas las notas del proyecto."
+    ),
+    "refine": (
+        "🔍 Ayuda sobre refinamiento\n\n"
+        "El refinamiento te ayuda a mejorar tus textos usando IA.\n\n"
+        "Para refinar un texto:\n"
+        "1. Selecciona '🔍 Refinar texto' del menú principal\n"
+        "2. Escribe el texto que quieres refinar\n"
+        "3. La IA te ayudará a refinar el texto\n\n"
+        "La IA detectará automáticamente el idioma del texto y lo refinará en el mismo idioma, manteniendo el significado original pero mejorando su presentación."
+    )
+}
+
+DEFAULT_HELP_TEXT = (
+    "❓ Ayuda general\n\n"
+    "Este bot te ayuda a organizar tus notas, ideas y proyectos.\n\n"
+    "Comandos principales:\n"
+    "• /start - Iniciar el bot\n"
+    "• /menu - Ver el menú principal\n"
+    "• /help - Ver esta ayuda\n\n"
+    "Para más ayuda específica, selecciona una categoría:\n"
+    "• 📝 Ayuda sobre notas\n"
+    "• 💡 Ayuda sobre ideas\n"
+    "• 📋 Ayuda sobre proyectos\n"
+    "• 🔍 Ayuda sobre refinamiento"
+)
+
 def get_help_text(help_type: str) -> str:
     """Obtiene el texto de ayuda según el tipo"""
-    if help_type == "notes":
-        return (
-            "📝 Ayuda sobre notas\n\n"
-            "Las notas te permiten guardar información importante para referencia posterior.\n\n"
-            "Para crear una nota:\n"
-            "1. Selecciona '📝 Nueva nota' del menú principal\n"
-            "2. Escribe el contenido de tu nota\n"
-            "3. La nota se guardará automáticamente\n\n"
-            "Para ver tus notas:\n"
-            "1. Selecciona '📝 Nueva nota' del menú principal\n"
-            "2. Verás una lista de tus notas más recientes\n"
-            "3. Selecciona una nota para ver su contenido\n\n"
-            "También puedes refinar una nota existente para mejorar su presentación."
-        )
-    elif help_type == "ideas":
-        return (
-            "💡 Ayuda sobre ideas\n\n"
-            "Las ideas te permiten guardar pensamientos o conceptos que quieres desarrollar más tarde.\n\n"
-            "Para guardar una idea:\n"
-            "1. Selecciona '💡 Nueva idea' del menú principal\n"
-            "2. Escribe tu idea\n"
-            "3. La idea se guardará automáticamente\n\n"
-            "Las ideas son similares a las notas, pero están diseñadas para conceptos más breves o en desarrollo."
-        )
-    elif help_type == "projects":
-        return (
-            "📋 Ayuda sobre proyectos\n\n"
-            "Los proyectos son carpetas donde puedes organizar tus notas por tema.\n\n"
-            "Para crear un proyecto:\n"
-            "1. Selecciona '📋 Proyectos' del menú principal\n"
-            "2. Selecciona '➕ Nuevo proyecto'\n"
-            "3. Escribe el nombre del proyecto\n\n"
-            "Para agregar una nota a un proyecto:\n"
-            "1. Selecciona un proyecto de la lista\n"
-            "2. Selecciona '➕ Nueva nota'\n"
-            "3. Escribe el contenido de tu nota\n\n"
-            "También puedes preguntar a la IA sobre un proyecto para obtener información basada en todas las notas del proyecto."
-        )
-    elif help_type == "refine":
-        return (
-            "🔍 Ayuda sobre refinamiento\n\n"
-            "El refinamiento te ayuda a mejorar tus textos usando IA.\n\n"
-            "Para refinar un texto:\n"
-            "1. Selecciona '🔍 Refinar texto' del menú principal\n"
-            "2. Escribe el texto que quieres refinar\n"
-            "3. La IA te ayudará a refinar el texto\n\n"
-            "La IA detectará automáticamente el idioma del texto y lo refinará en el mismo idioma, manteniendo el significado original pero mejorando su presentación."
-        )
-    else:
-        return (
-            "❓ Ayuda general\n\n"
-            "Este bot te ayuda a organizar tus notas, ideas y proyectos.\n\n"
-            "Comandos principales:\n"
-            "• /start - Iniciar el bot\n"
-            "• /menu - Ver el menú principal\n"
-            "• /help - Ver esta ayuda\n\n"
-            "Para más ayuda específica, selecciona una categoría:\n"
-            "• 📝 Ayuda sobre notas\n"
-            "• 💡 Ayuda sobre ideas\n"
-            "• 📋 Ayuda sobre proyectos\n"
-            "• 🔍 Ayuda sobre refinamiento"
+    return HELP_TEXTS.get(help_type, DEFAULT_HELP_TEXT)
+
+def get_prompt_manager() -> PromptManager:
+    """Returns the shared prompt manager"""
+    global _prompt_manager
+    if _prompt_manager is None:
+        _prompt_manager = PromptManager()
+    return _prompt_manager
+
+def get_cached_prompt() -> dict:
+    """Returns the base prompt, reading it only once until it is edited"""
+    global _prompt_cache
+    if _prompt_cache is None:
+        _prompt_cache = get_prompt_manager().get_prompt()
+    return _prompt_cache
+
+def invalidate_prompt_cache():
+    """Forgets the cached base prompt so the next call reloads it"""
+    global _prompt_cache
+    _prompt_cache = None
+
+def get_http_client() -> httpx.AsyncClient:
+    """Returns the shared HTTP client, keeping connections to Ollama alive between calls"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(
+            # Generations can take minutes, so only the connection attempt is bounded
+            timeout=httpx.Timeout(None, connect=10.0),
+            limits=httpx.Limits(max_connections=32, keepalive_expiry=60)
         )
+    return _http_client
+
+# Minimum seconds between edits of a message while its answer is streamed
+STREAM_UPDATE_INTERVAL = 1.5
+
+# Language instructions appended to the base prompt
+ENGLISH_INSTRUCTION = "Respond in English only, without translations."
+SPANISH_INSTRUCTION = "Responde en español únicamente, sin traducciones."
+
+# Answer given when the IA can't be reached, in the language of the message
+ENGLISH_AI_ERROR = "Sorry, I had a problem processing your message. Could you try again?"
+SPANISH_AI_ERROR = "Lo siento, tuve un problema al procesar tu mensaje. ¿Podrías intentarlo de nuevo?"
 
-async def process_with_ai(message: str, context: str = "") -> str:
-    """Processes a message with the IA"""
+async def iter_json_lines(response):
+    """Yields the JSON objects of a streamed JSON Lines response"""
+    # Parse straight from the received bytes, without decoding each line to str first
+    buffer = bytearray()
+    async for chunk in response.aiter_bytes():
+        buffer += chunk
+        start = 0
+        end = buffer.find(b"\n")
+        while end != -1:
+            line = memoryview(buffer)[start:end]
+            if line.nbytes:
+                yield orjson.loads(line)
+            line.release()
+            start = end + 1
+            end = buffer.find(b"\n", start)
+        del buffer[:start]
+    
+    if buffer.strip():
+        yield orjson.loads(buffer)
+
+async def process_with_ai(message: str, context: str = "", on_partial=None, english: Optional[bool] = None) -> str:
+    """Processes a message with the IA
+    
+    If on_partial is given, it is awaited with the text generated so far
+    at most once every STREAM_UPDATE_INTERVAL seconds. english is the
+    language of the message when the caller already detected it.
+    """
+    # Detect the language of the message
+    if english is None:
+        english = is_english(message)
+    
     try:
         # Prepare the request to Ollama
         ollama_url = f"{OLLAMA_HOST}/api/generate"
         
         # Get the current base prompt
-        prompt_manager = PromptManager()
-        base_prompt = prompt_manager.get_prompt()
+        base_prompt = get_cached_prompt()
         
-        # Detect the language of the message
-        is_english_text = is_english(message)
-        language_instruction = "Respond in English only, without translations." if is_english_text else "Responde en español únicamente, sin traducciones."
+        language_instruction = ENGLISH_INSTRUCTION if english else SPANISH_INSTRUCTION
         
-        # Construct the complete prompt
-        complete_prompt = f"{base_prompt['content']}\n\n{language_instruction}\n\n"
+        # Construct the complete prompt in a single join
+        parts = [base_prompt['content'], language_instruction]
         
         # If there's additional context, include it
         if context:
-            complete_prompt += f"Additional context:\n{context}\n\n"
+            parts.append(f"Additional context:\n{context}")
         
         # Add the user's message
-        complete_prompt += f"User: {message}\n\nAssistant:"
+        parts.append(f"User: {message}\n\nAssistant:")
+        complete_prompt = "\n\n".join(parts)
             
         payload = {
             "model": "gemma3",  # This model can be changed based on what's running in Ollama
             "prompt": complete_prompt,
-            "stream": False
+            "stream": True
         }
         
-        # Send request to Ollama
-        response = requests.post(ollama_url, json=payload)
-        response.raise_for_status()
+        # Stream the answer from Ollama: one JSON object per line, each with the next piece of text
+        chunks = []
+        shown = ""
+        last_update = time.monotonic()
+        async with get_http_client().stream("POST", ollama_url, json=payload) as response:
+            response.raise_for_status()
+            
+            async for data in iter_json_lines(response):
+                if "error" in data:
+                    raise RuntimeError(data["error"])
+                chunks.append(data.get("response", ""))
+                
+                if on_partial and time.monotonic() - last_update >= STREAM_UPDATE_INTERVAL:
+                    last_update = time.monotonic()
+                    partial = "".join(chunks)
+                    if partial.strip() and partial != shown:
+                        shown = partial
+                        try:
+                            await on_partial(partial)
+                        except Exception as e:
+                            # A failed preview must not interrupt the generation
+                            logger.warning(f"Error showing partial IA response: {str(e)}")
         
-        # Process response
-        ai_response = response.json()['response']
+        ai_response = "".join(chunks)
         
         return ai_response
         
     except Exception as e:
         logger.error(f"Error processing with IA: {str(e)}")
-        error_message = "Sorry, I had a problem processing your message. Could you try again?" if is_english_text else "Lo siento, tuve un problema al procesar tu mensaje. ¿Podrías intentarlo de nuevo?"
-        return error_message
+        return ENGLISH_AI_ERROR if english else SPANISH_AI_ERROR
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE, callback_data=None):
-    query = update.callback_query
-    user_id = query.from_user.id
+async def edit_message(message, text, **kwargs):
+    """Edits a message sent by the bot, ignoring edits that change nothing"""
+    try:
+        await message.edit_text(text, **kwargs)
+    except BadRequest as e:
+        # Pressing the same button twice re-renders identical content
+        if "Message is not modified" not in str(e):
+            raise
 
-    if user_id not in ALLOWED_USERS:
-        await query.answer("Lo siento, no tienes permiso para usar este bot.")
-        return
+# Callback handlers, looked up by exact callback_data first and then by prefix
+CALLBACK_ROUTES = {}
+CALLBACK_PREFIX_ROUTES = []
 
-    # Usar el callback_data proporcionado o el del query
-    data = callback_data if callback_data else query.data
+def callback_route(data: str):
+    """Registers a handler for an exact callback_data value"""
+    def decorator(handler):
+        CALLBACK_ROUTES[data] = handler
+        return handler
+    return decorator
 
-    if data == "menu_main":
-        user_states[user_id] = None
-        await query.message.edit_text(
-            "¡Bienvenido al Asistente de Notas! ¿Qué te gustaría hacer?",
-            reply_markup=interface.create_main_menu()
-        )
+def callback_prefix(prefix: str):
+    """Registers a handler for callback_data starting with prefix; it receives the rest as arg"""
+    def decorator(handler):
+        CALLBACK_PREFIX_ROUTES.append((prefix, handler))
+        return handler
+    return decorator
 
-    elif data == "base_prompt":
-        prompt_manager = PromptManager()
-        base_prompt = prompt_manager.get_prompt()
-        
-        message = (
-            "🤖 *Prompt Base Actual*\n\n"
-            f"```\n{base_prompt['content']}\n```\n\n"
-            "Puedes editar este prompt haciendo clic en 'Editar prompt'."
-        )
-        
-        await query.message.edit_text(
-            text=message,
-            parse_mode='Markdown',
-            reply_markup=interface.create_base_prompt_menu(base_prompt['content'])
-        )
+def enter_state(context: ContextTypes.DEFAULT_TYPE, user_id: int, state):
+    """Switches what the bot waits for from the user, dropping a pending base prompt edit"""
+    user_states[user_id] = state
+    context.user_data.pop('waiting_for_base_prompt', None)
+
+@callback_route("menu_main")
+async def on_menu_main(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the main menu"""
+    user_states[user_id] = None
+    context.user_data.pop('waiting_for_base_prompt', None)
+    await edit_message(
+        query.message,
+        "¡Bienvenido al Asistente de Notas! ¿Qué te gustaría hacer?",
+        reply_markup=interface.create_main_menu()
+    )
+
+@callback_route("base_prompt")
+async def on_base_prompt(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the current base prompt"""
+    base_prompt = get_cached_prompt()
 
-    elif data == "edit_base_prompt":
-        context.user_data['waiting_for_base_prompt'] = True
-        await query.message.edit_text(
-            text=(
-                "✏️ *Editar Prompt Base*\n\n"
-                "Por favor, envía el nuevo prompt base para la IA.\n\n"
-                "Este prompt se usará como base para todas las interacciones con la IA.\n"
-                "Puedes incluir instrucciones específicas sobre cómo debe comportarse la IA."
-            ),
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Cancelar", callback_data="menu_main")
-            ]])
+    message = (
+        "🤖 *Prompt Base Actual*\n\n"
+        f"```\n{base_prompt['content']}\n```\n\n"
+        "Puedes editar este prompt haciendo clic en 'Editar prompt'."
+    )
+
+    await edit_message(
+        query.message,
+        text=message,
+        parse_mode='Markdown',
+        reply_markup=interface.create_base_prompt_menu(base_prompt['content'])
+    )
+
+@callback_route("edit_base_prompt")
+async def on_edit_base_prompt(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for a new base prompt"""
+    user_states.pop(user_id, None)
+    context.user_data['waiting_for_base_prompt'] = True
+    await edit_message(
+        query.message,
+        text=(
+            "✏️ *Editar Prompt Base*\n\n"
+            "Por favor, envía el nuevo prompt base para la IA.\n\n"
+            "Este prompt se usará como base para todas las interacciones con la IA.\n"
+            "Puedes incluir instrucciones específicas sobre cómo debe comportarse la IA."
+        ),
+        parse_mode='Markdown',
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("🔙 Cancelar", callback_data="menu_main")
+        ]])
+    )
+
+@callback_route("new_note")
+async def on_new_note(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for the content of a new note"""
+    enter_state(context, user_id, "waiting_for_note")
+    await edit_message(
+        query.message,
+        "📝 *Nueva Nota*\n\nPor favor, escribe el contenido de tu nota:",
+        parse_mode='Markdown',
+        reply_markup=interface.create_cancel_menu()
+    )
+
+@callback_route("new_idea")
+async def on_new_idea(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for a new idea"""
+    enter_state(context, user_id, "waiting_for_idea")
+    await edit_message(
+        query.message,
+        "💡 *Nueva Idea*\n\nPor favor, escribe tu idea:",
+        parse_mode='Markdown',
+        reply_markup=interface.create_cancel_menu()
+    )
+
+def leave_pending_state(user_id: int):
+    """Stops waiting for text from the user, dropping the project notes kept for a project chat"""
+    user_states.pop(user_id, None)
+
+@callback_route("menu_projects")
+async def on_menu_projects(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the list of projects"""
+    leave_pending_state(user_id)
+    projects = note_manager.get_projects()
+    await edit_message(
+        query.message,
+        "📋 *Proyectos*\n\nSelecciona un proyecto para ver sus notas o crear uno nuevo:",
+        parse_mode='Markdown',
+        reply_markup=interface.create_projects_menu(projects)
+    )
+
+async def show_project_not_found(message):
+    """Replaces a message with the projects list when a project no longer exists"""
+    await edit_message(
+        message,
+        "❌ Proyecto no encontrado.",
+        reply_markup=interface.create_projects_menu(note_manager.get_projects())
+    )
+
+@callback_route("new_project")
+async def on_new_project(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for the name of a new project"""
+    enter_state(context, user_id, "waiting_for_project_name")
+    await edit_message(
+        query.message,
+        "📋 *Nuevo Proyecto*\n\nPor favor, escribe el nombre del proyecto:",
+        parse_mode='Markdown',
+        reply_markup=interface.create_cancel_menu()
+    )
+
+def project_view(project):
+    """Builds the text and buttons that show a project and its notes"""
+    project_notes = note_manager.get_notes_by_project(project['id'])
+    keyboard = []
+
+    if project_notes:
+        for note in project_notes:
+            keyboard.append([interface.create_note_button(note['id'], "📝", note['title'])])
+    else:
+        keyboard.append([InlineKeyboardButton("No hay notas en este proyecto", callback_data="dummy")])
+
+    # Agregar botones de acción del proyecto
+    keyboard.extend(interface.create_project_buttons(project['id']).inline_keyboard)
+
+    return interface.format_project_message(project, project_notes), InlineKeyboardMarkup(keyboard)
+
+@callback_prefix("project_")
+async def on_project(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows a project and its notes"""
+    # The back buttons of the project chat and of the new project note prompt lead here
+    leave_pending_state(user_id)
+    project_id = arg
+    project = note_manager.get_project(project_id)
+
+    if project:
+        text, reply_markup = project_view(project)
+        await edit_message(query.message, text=text, reply_markup=reply_markup)
+    else:
+        await show_project_not_found(query.message)
+
+@callback_prefix("new_project_note_")
+async def on_new_project_note(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for the content of a new project note"""
+    project_id = arg
+    project = note_manager.get_project(project_id)
+
+    if project:
+        # The prompt message is kept so it can show the project again once the note is saved
+        enter_state(context, user_id, {
+            "state": "waiting_for_project_note",
+            "project_id": project_id,
+            "prompt_message": query.message
+        })
+        await edit_message(
+            query.message,
+            text=f"📝 Vamos a agregar una nota al proyecto '{project['title']}'.\n\n"
+                 f"Por favor, envía el contenido de tu nota.\n"
+                 f"Esta nota se guardará automáticamente en el proyecto seleccionado.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancelar", callback_data=f"project_{project_id}")]])
         )
+    else:
+        await show_project_not_found(query.message)
 
-    elif data == "new_note":
-        user_states[user_id] = "waiting_for_note"
-        await query.message.edit_text(
-            "📝 *Nueva Nota*\n\nPor favor, escribe el contenido de tu nota:",
-            parse_mode='Markdown',
-            reply_markup=interface.create_cancel_menu()
+@callback_route("refine_message")
+async def on_refine_message(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for a text to refine"""
+    enter_state(context, user_id, {"state": "waiting_for_refinement"})
+    await edit_message(
+        query.message,
+        text="🔍 Vamos a refinar tu texto.\n\n"
+             "Por favor, envía el contenido que quieres refinar.\n"
+             "Usaré la IA para ayudarte a mejorarlo, manteniendo su significado principal pero mejorando su presentación.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancelar", callback_data="menu_main")]])
+    )
+
+REFINE_PROMPT = "Refina el siguiente texto para hacerlo más claro y conciso, manteniendo su significado principal. Si está en español, refínalo en español. Si está en inglés, refínalo en inglés."
+
+@callback_prefix("refine_note_")
+async def on_refine_note(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Asks for confirmation before refining a note"""
+    note_id = arg
+    note = note_manager.get_note(note_id)
+
+    if note:
+        # Refining a note is driven by the buttons below, so no text is awaited
+        enter_state(context, user_id, None)
+        await edit_message(
+            query.message,
+            text=f"🔍 Vamos a refinar esta nota:\n\n{note['content']}\n\n"
+                 f"¿Quieres proceder con el refinamiento?",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("✅ Refinar", callback_data=f"confirm_refine_{note_id}")],
+                [InlineKeyboardButton("🔙 Cancelar", callback_data=f"note_{note_id}")]
+            ])
         )
+
+@callback_prefix("confirm_refine_")
+async def on_confirm_refine(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Refines a note with the IA"""
+    note_id = arg
+    note = note_manager.get_note(note_id)
+
+    if note:
+        # Refining can take a while, so say so before asking the IA
+        await edit_message(query.message, f"⏳ Refinando la nota {note_id}...")
         
-    elif data == "new_idea":
-        user_states[user_id] = "waiting_for_idea"
-        await query.message.edit_text(
-            "💡 *Nueva Idea*\n\nPor favor, escribe tu idea:",
-            parse_mode='Markdown',
-            reply_markup=interface.create_cancel_menu()
-        )
+        original_content = note['content']
+        refined_text = await process_with_ai(original_content, REFINE_PROMPT)
 
-    elif data == "menu_projects":
-        projects = note_manager.get_projects()
-        await query.message.edit_text(
-            "📋 *Proyectos*\n\nSelecciona un proyecto para ver sus notas o crear uno nuevo:",
-            parse_mode='Markdown',
-            reply_markup=interface.create_projects_menu(projects)
-        )
+        # The stored note is updated in place, so keep the original text for the message
+        note_manager.update_note(note_id, refined_text)
 
-    elif data == "new_project":
-        user_states[user_id] = "waiting_for_project_name"
-        await query.message.edit_text(
-            "📋 *Nuevo Proyecto*\n\nPor favor, escribe el nombre del proyecto:",
-            parse_mode='Markdown',
-            reply_markup=interface.create_cancel_menu()
+        await edit_message(
+            query.message,
+            text=f"✅ ¡Nota refinada con éxito!\n\n"
+                 f"Texto original:\n{original_content}\n\n"
+                 f"Texto refinado:\n{refined_text}",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a notas", callback_data="menu_notes")]])
         )
 
-    elif data.startswith("project_"):
-        project_id = data.split("_")[1]
-        project = note_manager.get_project(project_id)
-        
-        if project:
-            project_notes = note_manager.get_notes_by_project(project_id)
-            keyboard = []
-            
-            if project_notes:
-                for note in project_notes:
-                    keyboard.append([
-                        InlineKeyboardButton(
-                            f"📝 {note['id']} - {note['content'][:30]}...",
-                            callback_data=f"note_{note['id']}"
-                        )
-                    ])
-            else:
-                keyboard.append([InlineKeyboardButton("No hay notas en este proyecto", callback_data="dummy")])
-            
-            # Agregar botones de acción del proyecto
-            keyboard.extend(interface.create_project_buttons(project_id).inline_keyboard)
-            
-            await query.message.edit_text(
-                text=interface.format_project_message(project, project_notes),
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        else:
-            await query.message.edit_text(
-                "❌ Proyecto no encontrado.",
-                reply_markup=interface.create_projects_menu(note_manager.get_projects())
-            )
+@callback_route("cancel")
+async def on_cancel(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Cancels the current operation"""
+    user_states[user_id] = None
+    context.user_data.pop('waiting_for_base_prompt', None)
+    await edit_message(
+        query.message,
+        "❌ Operación cancelada.\n\n¿Qué te gustaría hacer?",
+        reply_markup=interface.create_main_menu()
+    )
 
-    elif data.startswith("new_project_note_"):
-        project_id = data.split("_")[3]
-        project = note_manager.get_project(project_id)
-        
-        if project:
-            user_states[user_id] = {
-                "state": "waiting_for_project_note",
-                "project_id": project_id
-            }
-            await query.message.edit_text(
-                text=f"📝 Vamos a agregar una nota al proyecto '{project['title']}'.\n\n"
-                     f"Por favor, envía el contenido de tu nota.\n"
-                     f"Esta nota se guardará automáticamente en el proyecto seleccionado.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancelar", callback_data=f"project_{project_id}")]])
+@callback_prefix("ask_project_")
+async def on_ask_project(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Starts a conversation with the IA about a project"""
+    project_id = arg
+    project = note_manager.get_project(project_id)
+
+    if project:
+        project_notes = note_manager.get_notes_by_project(project_id)
+
+        if project_notes:
+            # Build the context in one join, whatever the number of notes
+            parts = [f"Estoy trabajando en un proyecto llamado '{project['title']}'. Aquí están las notas del proyecto:\n\n"]
+            parts.extend(f"Nota #{note['id']}:\n{note['content']}\n\n" for note in project_notes)
+            parts.append("Estoy listo para responder preguntas sobre este proyecto basado en estas notas.")
+            project_context = "".join(parts)
+
+            enter_state(context, user_id, {"state": "project_chat", "project_id": project_id, "context": project_context})
+
+            await edit_message(
+                query.message,
+                text=f"🤖 Estoy listo para responder preguntas sobre el proyecto '{project['title']}'.\n\n"
+                     f"Este proyecto tiene {len(project_notes)} notas.\n"
+                     f"Puedes hacerme cualquier pregunta sobre el contenido de estas notas.\n\n"
+                     f"Para salir de este modo, selecciona '🔙 Volver a proyectos'.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a proyectos", callback_data=f"project_{project_id}")]])
             )
         else:
-            await query.message.edit_text(
-                "❌ Proyecto no encontrado.",
-                reply_markup=interface.create_projects_menu(note_manager.get_projects())
+            await edit_message(
+                query.message,
+                text=f"🤖 El proyecto '{project['title']}' no tiene notas todavía.\n\n"
+                     f"Agrega algunas notas antes de hacer preguntas sobre el proyecto.",
+                reply_markup=interface.create_project_buttons(project_id)
             )
 
-    elif data == "refine_message":
-        user_states[user_id] = {"state": "waiting_for_refinement"}
-        await query.message.edit_text(
-            text="🔍 Vamos a refinar tu texto.\n\n"
-                 "Por favor, envía el contenido que quieres refinar.\n"
-                 "Usaré la IA para ayudarte a mejorarlo, manteniendo su significado principal pero mejorando su presentación.",
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Cancelar", callback_data="menu_main")]])
-        )
+@callback_route("help")
+async def on_help(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the help menu"""
+    await edit_message(
+        query.message,
+        text=HELP_MENU_TEXT,
+        reply_markup=interface.create_help_menu()
+    )
 
-    elif data.startswith("refine_note_"):
-        note_id = data.split("_")[2]
-        note = note_manager.get_note(note_id)
-        
-        if note:
-            user_states[user_id] = {"state": "waiting_for_refinement", "note_id": note_id}
-            await query.message.edit_text(
-                text=f"🔍 Vamos a refinar esta nota:\n\n{note['content']}\n\n"
-                     f"¿Quieres proceder con el refinamiento?",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Refinar", callback_data=f"confirm_refine_{note_id}")],
-                    [InlineKeyboardButton("🔙 Cancelar", callback_data=f"note_{note_id}")]
-                ])
-            )
+@callback_prefix("help_")
+async def on_help_topic(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the help text of a topic"""
+    help_type = arg
+    help_text = get_help_text(help_type)
 
-    elif data.startswith("confirm_refine_"):
-        note_id = data.split("_")[2]
-        note = note_manager.get_note(note_id)
-        
-        if note:
-            prompt = "Refina el siguiente texto para hacerlo más claro y conciso, manteniendo su significado principal. Si está en español, refínalo en español. Si está en inglés, refínalo en inglés."
-            refined_text = await process_with_ai(note['content'], prompt)
-            
-            note_manager.update_note(note_id, refined_text)
-            
-            await query.message.edit_text(
-                text=f"✅ ¡Nota refinada con éxito!\n\n"
-                     f"Texto original:\n{note['content']}\n\n"
-                     f"Texto refinado:\n{refined_text}",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a notas", callback_data="menu_notes")]])
-            )
+    await edit_message(
+        query.message,
+        text=help_text,
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a ayuda", callback_data="help")]])
+    )
 
-    elif data == "cancel":
-        user_states[user_id] = None
-        await query.message.edit_text(
-            "❌ Operación cancelada.\n\n¿Qué te gustaría hacer?",
-            reply_markup=interface.create_main_menu()
-        )
+@callback_route("menu_notes")
+async def on_menu_notes(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows the most recent notes"""
+    leave_pending_state(user_id)
+    notes = note_manager.get_recent_notes()
+    await edit_message(
+        query.message,
+        text="📝 *Notas Recientes*\n\nSelecciona una nota para ver su contenido o crear una nueva:",
+        parse_mode='Markdown',
+        reply_markup=interface.create_notes_menu(notes)
+    )
 
-    elif data.startswith("ask_project_"):
-        project_id = data.split("_")[2]
-        project = note_manager.get_project(project_id)
-        
-        if project:
-            project_notes = note_manager.get_notes_by_project(project_id)
-            
-            if project_notes:
-                context = f"Estoy trabajando en un proyecto llamado '{project['title']}'. Aquí están las notas del proyecto:\n\n"
-                for note in project_notes:
-                    context += f"Nota #{note['id']}:\n{note['content']}\n\n"
-                    
-                context += "Estoy listo para responder preguntas sobre este proyecto basado en estas notas."
-                
-                user_states[user_id] = {"state": "project_chat", "project_id": project_id, "context": context}
-                
-                await query.message.edit_text(
-                    text=f"🤖 Estoy listo para responder preguntas sobre el proyecto '{project['title']}'.\n\n"
-                         f"Este proyecto tiene {len(project_notes)} notas.\n"
-                         f"Puedes hacerme cualquier pregunta sobre el contenido de estas notas.\n\n"
-                         f"Para salir de este modo, selecciona '🔙 Volver a proyectos'.",
-                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a proyectos", callback_data=f"project_{project_id}")]])
-                )
-            else:
-                await query.message.edit_text(
-                    text=f"🤖 El proyecto '{project['title']}' no tiene notas todavía.\n\n"
-                         f"Agrega algunas notas antes de hacer preguntas sobre el proyecto.",
-                    reply_markup=interface.create_project_buttons(project_id)
-                )
-
-    elif data == "help":
-        help_text = (
-            "❓ ¿Con qué necesitas ayuda?\n\n"
-            "Puedo ayudarte con:\n"
-            "• Cómo guardar y organizar notas\n"
-            "• Cómo guardar ideas\n"
-            "• Cómo crear y gestionar proyectos\n"
-            "• Cómo refinar textos con IA\n\n"
-            "Selecciona una opción para ver más detalles:"
+@callback_prefix("note_")
+async def on_note(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Shows a note"""
+    leave_pending_state(user_id)
+    note_id = arg
+    note = note_manager.get_note(note_id)
+
+    if note:
+        await edit_message(
+            query.message,
+            text=interface.format_note_message(note),
+            reply_markup=interface.create_note_buttons(note_id)
         )
-        
-        await query.message.edit_text(
-            text=help_text,
-            reply_markup=interface.create_help_menu()
+    else:
+        await edit_message(
+            query.message,
+            "❌ Nota no encontrada.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a notas", callback_data="menu_notes")]])
         )
 
-    elif data.startswith("help_"):
-        help_type = data.split("_")[1]
-        help_text = get_help_text(help_type)
+@callback_prefix("chat_project_")
+async def on_chat_project(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, arg: str):
+    """Redirects to ask_project_ to keep compatibility"""
+    await on_ask_project(query, context, user_id, arg)
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = query.from_user.id
+
+    if user_id not in ALLOWED_USERS:
+        await query.answer("Lo siento, no tienes permiso para usar este bot.")
+        return
+
+    # Answer right away so the client stops showing the loading spinner
+    await query.answer()
+
+    data = query.data
+
+    handler = CALLBACK_ROUTES.get(data)
+    if handler:
+        await handler(query, context, user_id, "")
+        return
+
+    for prefix, handler in CALLBACK_PREFIX_ROUTES:
+        if data.startswith(prefix):
+            # Everything after the prefix is the ID, even if it contains underscores
+            await handler(query, context, user_id, data[len(prefix):])
+            return
+
+# Handlers for the text a user sends while a menu option is waiting for it, looked up by state
+MESSAGE_STATE_ROUTES = {}
+
+def message_state(state: str):
+    """Registers a handler for messages received in the given user state"""
+    def decorator(handler):
+        MESSAGE_STATE_ROUTES[state] = handler
+        return handler
+    return decorator
+
+async def reply_with_ai(message, text: str, ai_context: str = ""):
+    """Answers a message with the IA, showing the answer while it's being generated"""
+    english = is_english(text)
+    try:
+        reply = await message.reply_text("⏳")
         
-        await query.message.edit_text(
-            text=help_text,
-            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a ayuda", callback_data="help")]])
-        )
+        async def show_partial(partial):
+            await edit_message(reply, partial)
+        
+        ai_response = await process_with_ai(text, ai_context, on_partial=show_partial, english=english)
+        
+        # Send the complete IA response
+        await edit_message(reply, ai_response)
+        
+    except Exception as e:
+        logger.error(f"Error processing message with IA: {str(e)}")
+        await message.reply_text(ENGLISH_AI_ERROR if english else SPANISH_AI_ERROR)
+
+@message_state("waiting_for_note")
+async def on_note_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Saves a new note"""
+    note = note_manager.create_note(update.message.text)
+    user_states[user_id] = None
+    await update.message.reply_text(
+        f"✅ Nota guardada: #{note['id']}",
+        reply_markup=interface.create_main_menu()
+    )
+
+@message_state("waiting_for_idea")
+async def on_idea_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Saves a new idea"""
+    idea = note_manager.create_idea(update.message.text)
+    user_states[user_id] = None
+    await update.message.reply_text(
+        f"✅ Idea guardada: #{idea['id']}",
+        reply_markup=interface.create_main_menu()
+    )
 
-    elif data == "menu_notes":
-        notes = note_manager.get_recent_notes()
-        await query.message.edit_text(
-            text="📝 *Notas Recientes*\n\nSelecciona una nota para ver su contenido o crear una nueva:",
-            parse_mode='Markdown',
-            reply_markup=interface.create_notes_menu(notes)
+@message_state("waiting_for_project_name")
+async def on_project_name_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Creates a new project"""
+    project = note_manager.create_project(update.message.text)
+    if project is None:
+        # Keep waiting for a name the user can fix
+        await update.message.reply_text(
+            "❌ El nombre del proyecto no puede contener '/' ni '\\', ni ser '.' o '..'.\n\n"
+            "Por favor, escribe otro nombre:",
+            reply_markup=interface.create_cancel_menu()
         )
+        return
+    
+    user_states[user_id] = None
+    # The new project is already in the in-memory list; nothing is read back from disk
+    await update.message.reply_text(
+        f"✅ Proyecto '{project['title']}' creado exitosamente.",
+        reply_markup=interface.create_projects_menu(note_manager.get_projects())
+    )
 
-    elif data.startswith("note_"):
-        note_id = data.split("_")[1]
-        note = note_manager.get_note(note_id)
-        
-        if note:
-            await query.message.edit_text(
-                text=interface.format_note_message(note),
-                reply_markup=interface.create_note_buttons(note_id)
-            )
-        else:
-            await query.message.edit_text(
-                "❌ Nota no encontrada.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Volver a notas", callback_data="menu_notes")]])
-            )
+@message_state("waiting_for_project_note")
+async def on_project_note_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Saves a new note inside a project"""
+    project_id = state["project_id"]
+    note = note_manager.create_note(update.message.text, project_id)
+    user_states[user_id] = None
+
+    # Turn the message that asked for the note back into the project, now listing it
+    project = note_manager.get_project(project_id)
+    prompt_message = state.get("prompt_message")
+    if project and prompt_message:
+        text, reply_markup = project_view(project)
+        try:
+            await edit_message(prompt_message, f"✅ Nota guardada: #{note['id']}\n\n{text}", reply_markup=reply_markup)
+            return
+        except BadRequest as e:
+            logger.warning(f"Error showing project {project_id} after saving a note: {str(e)}")
 
-    elif data.startswith("chat_project_"):
-        # Redirigir a ask_project_ para mantener compatibilidad
-        project_id = data.split("_")[2]
-        await handle_callback(update, context, f"ask_project_{project_id}")
+    await update.message.reply_text(
+        f"✅ Nota guardada en el proyecto: #{note['id']}",
+        reply_markup=interface.create_project_buttons(project_id)
+    )
 
-    await query.answer()
+@message_state("waiting_for_refinement")
+async def on_refinement_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Refines a text sent by the user"""
+    user_states[user_id] = None
+    await reply_with_ai(update.message, update.message.text, REFINE_PROMPT)
+
+@message_state("project_chat")
+async def on_project_chat_text(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, state: dict):
+    """Answers a question about the project being discussed"""
+    await reply_with_ai(update.message, update.message.text, state["context"])
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.message.from_user.id
@@ -846,62 +1397,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ Lo siento, no tienes permiso para usar este bot.")
         return
 
-    if user_id in user_states:
-        state = user_states[user_id]
-        
-        if state == "waiting_for_note":
-            # Crear una nueva nota
-            note = note_manager.create_note(message_text)
-            user_states[user_id] = None
+    if context.user_data.pop('waiting_for_base_prompt', False):
+        # Save the new base prompt sent after pressing "Editar prompt"
+        if get_prompt_manager().update_base_prompt(message_text):
+            invalidate_prompt_cache()
             await update.message.reply_text(
-                f"✅ Nota guardada con ID: {note['id']}\n\n"
-                f"Contenido:\n{note['content'][:100]}...",
+                "✅ Prompt base actualizado.",
                 reply_markup=interface.create_main_menu()
             )
-            
-        elif state == "waiting_for_idea":
-            # Crear una nueva idea
-            idea = note_manager.create_idea(message_text)
-            user_states[user_id] = None
+        else:
             await update.message.reply_text(
-                f"✅ Idea guardada con ID: {idea['id']}\n\n"
-                f"Contenido:\n{idea['content'][:100]}...",
+                "❌ No se pudo actualizar el prompt base.",
                 reply_markup=interface.create_main_menu()
             )
-            
-        elif state == "waiting_for_project_name":
-            # Crear un nuevo proyecto
-            project = note_manager.create_project(message_text)
-            user_states[user_id] = None
-            await update.message.reply_text(
-                f"✅ Proyecto '{project['title']}' creado exitosamente.",
-                reply_markup=interface.create_projects_menu(note_manager.get_projects())
-            )
-            
-        elif state == "waiting_for_project_note":
-            # Crear una nota dentro de un proyecto
-            project_id = user_states[user_id]["project_id"]
-            note = note_manager.create_note(message_text, project_id)
-            user_states[user_id] = None
-            await update.message.reply_text(
-                f"✅ Nota guardada en el proyecto con ID: {note['id']}\n\n"
-                f"Contenido:\n{note['content'][:100]}...",
-                reply_markup=interface.create_project_buttons(project_id)
-            )
-    
+        return
+
+    state = user_states.get(user_id)
+    # Simple states are stored as a string, states that carry data as a dict
+    state_data = state if isinstance(state, dict) else {"state": state}
+
+    handler = MESSAGE_STATE_ROUTES.get(state_data["state"])
+    if handler:
+        await handler(update, context, user_id, state_data)
     else:
         # If there's no state, process directly with the IA
-        try:
-            # Process with the IA without any additional context
-            ai_response = await process_with_ai(message_text)
-            
-            # Send the IA response
-            await update.message.reply_text(ai_response)
-            
-        except Exception as e:
-            logger.error(f"Error processing message with IA: {str(e)}")
-            error_message = "Sorry, I had a problem processing your message. Could you try again?" if is_english(message_text) else "Lo siento, tuve un problema al procesar tu mensaje. ¿Podrías intentarlo de nuevo?"
-            await update.message.reply_text(error_message)
+        await reply_with_ai(update.message, message_text)
 
 async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handles received commands"""
@@ -922,10 +1442,56 @@ async def handle_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             "Command not recognized. Use /help to see available commands."
         )
 
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates from different users concurrently and those from the same user in order"""
+    
+    def __init__(self, max_concurrent_updates: int):
+        # The base class takes its semaphore before do_process_update, so updates waiting for their
+        # user's lock would hold slots other users need; the real limit is applied after the lock
+        super().__init__(sys.maxsize)
+        self._update_slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        # A lock only lives while an update of its user is running or waiting for it
+        self._locks = weakref.WeakValueDictionary()
+    
+    async def do_process_update(self, update, coroutine) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._update_slots:
+                await coroutine
+            return
+        
+        lock = self._locks.get(user.id)
+        if lock is None:
+            lock = self._locks[user.id] = asyncio.Lock()
+        async with lock, self._update_slots:
+            await coroutine
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+async def on_shutdown(application: Application) -> None:
+    """Writes pending changes and closes connections before the bot stops"""
+    await note_manager.flush_async()
+    
+    if _http_client is not None:
+        await _http_client.aclose()
+
 def main():
     """Starts the bot"""
     # Configure the bot
-    application = Application.builder().token(BOT_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        # Queue outgoing requests below Telegram's limits instead of hitting 429 errors
+        .rate_limiter(AIORateLimiter(overall_max_rate=25))
+        # A slow IA answer for one user must not hold back everybody else's buttons
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_shutdown(on_shutdown)
+        .build()
+    )
 
     # Command handlers
     application.add_handler(CommandHandler("start", start))
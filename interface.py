@@ -1,41 +1,61 @@
 import os
+from functools import lru_cache
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 
+# Menús que no dependen de ningún dato; se construyen una sola vez
+MAIN_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 New note", callback_data="new_note")],
+    [InlineKeyboardButton("💡 New idea", callback_data="new_idea")],
+    [InlineKeyboardButton("📋 Projects", callback_data="menu_projects")],
+    [InlineKeyboardButton("🔍 Refine text", callback_data="refine_message")],
+    [InlineKeyboardButton("🤖 Base prompt", callback_data="base_prompt")],
+    [InlineKeyboardButton("❓ Help", callback_data="help")]
+])
+
+BASE_PROMPT_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("✏️ Edit prompt", callback_data="edit_base_prompt")],
+    [InlineKeyboardButton("🔙 Main menu", callback_data="menu_main")]
+])
+
+HELP_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📝 Notes help", callback_data="help_notes")],
+    [InlineKeyboardButton("💡 Ideas help", callback_data="help_ideas")],
+    [InlineKeyboardButton("📋 Projects help", callback_data="help_projects")],
+    [InlineKeyboardButton("🔍 Refinement help", callback_data="help_refine")],
+    [InlineKeyboardButton("🔙 Main menu", callback_data="menu_main")]
+])
+
+CANCEL_MENU_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
+])
+
 class InterfaceGenerator:
     """Clase para generar interfaces de usuario"""
     
     @staticmethod
     def create_main_menu():
         """Crea el menú principal"""
-        keyboard = [
-            [InlineKeyboardButton("📝 New note", callback_data="new_note")],
-            [InlineKeyboardButton("💡 New idea", callback_data="new_idea")],
-            [InlineKeyboardButton("📋 Projects", callback_data="menu_projects")],
-            [InlineKeyboardButton("🔍 Refine text", callback_data="refine_message")],
-            [InlineKeyboardButton("🤖 Base prompt", callback_data="base_prompt")],
-            [InlineKeyboardButton("❓ Help", callback_data="help")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return MAIN_MENU_MARKUP
     
     @staticmethod
     def create_base_prompt_menu(prompt_content):
         """Crea el menú para ver y editar el prompt base"""
-        keyboard = [
-            [InlineKeyboardButton("✏️ Edit prompt", callback_data="edit_base_prompt")],
-            [InlineKeyboardButton("🔙 Main menu", callback_data="menu_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return BASE_PROMPT_MENU_MARKUP
     
     @staticmethod
     def create_notes_menu(notes):
         """Crea el menú de notas"""
-        keyboard = []
-        
+        return InterfaceGenerator._build_notes_menu(tuple((note['id'], note['title']) for note in notes))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _build_notes_menu(entries):
+        """Construye el menú de notas; se reutiliza mientras las notas no cambien"""
         # Agregar botones para cada nota
-        for note in notes:
-            # Crear un título corto para la nota (primeros 30 caracteres)
-            title = note['content'][:30] + "..." if len(note['content']) > 30 else note['content']
-            keyboard.append([InlineKeyboardButton(f"📝 {note['id']} - {title}", callback_data=f"note_{note['id']}")])
+        keyboard = [
+            [InlineKeyboardButton(f"📝 {note_id} - {title}", callback_data=f"note_{note_id}")]
+            for note_id, title in entries
+        ]
         
         # Agregar botones de acción
         keyboard.append([InlineKeyboardButton("➕ New note", callback_data="new_note")])
@@ -46,11 +66,17 @@ class InterfaceGenerator:
     @staticmethod
     def create_projects_menu(projects):
         """Crea el menú de proyectos"""
-        keyboard = []
-        
+        return InterfaceGenerator._build_projects_menu(tuple((project['id'], project['title']) for project in projects))
+    
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def _build_projects_menu(entries):
+        """Construye el menú de proyectos; se reutiliza mientras los proyectos no cambien"""
         # Agregar botones para cada proyecto
-        for project in projects:
-            keyboard.append([InlineKeyboardButton(f"📋 {project['title']}", callback_data=f"project_{project['id']}")])
+        keyboard = [
+            [InlineKeyboardButton(f"📋 {title}", callback_data=f"project_{project_id}")]
+            for project_id, title in entries
+        ]
         
         # Agregar botones de acción
         keyboard.append([InlineKeyboardButton("➕ New project", callback_data="new_project")])
@@ -61,16 +87,10 @@ class InterfaceGenerator:
     @staticmethod
     def create_help_menu():
         """Crea el menú de ayuda"""
-        keyboard = [
-            [InlineKeyboardButton("📝 Notes help", callback_data="help_notes")],
-            [InlineKeyboardButton("💡 Ideas help", callback_data="help_ideas")],
-            [InlineKeyboardButton("📋 Projects help", callback_data="help_projects")],
-            [InlineKeyboardButton("🔍 Refinement help", callback_data="help_refine")],
-            [InlineKeyboardButton("🔙 Main menu", callback_data="menu_main")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return HELP_MENU_MARKUP
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def create_note_buttons(note_id):
         """Crea los botones para una nota"""
         keyboard = [
@@ -80,6 +100,7 @@ class InterfaceGenerator:
         return InlineKeyboardMarkup(keyboard)
     
     @staticmethod
+    @lru_cache(maxsize=512)
     def create_project_buttons(project_id):
         """Crea los botones para un proyecto"""
         keyboard = [
@@ -92,10 +113,7 @@ class InterfaceGenerator:
     @staticmethod
     def create_cancel_menu():
         """Crea el menú de cancelación"""
-        keyboard = [
-            [InlineKeyboardButton("❌ Cancel", callback_data="cancel")]
-        ]
-        return InlineKeyboardMarkup(keyboard)
+        return CANCEL_MENU_MARKUP
     
     @staticmethod
     def format_note_message(note):
@@ -110,7 +128,6 @@ class InterfaceGenerator:
         if notes:
             message += "Project notes:\n\n"
             for note in notes:
-                title = note['content'][:30] + "..." if len(note['content']) > 30 else note['content']
-                message += f"• {note['id']} - {title}\n"
+                message += f"• {note['id']} - {note['title']}\n"
         
-        return message 
\ No newline at end of file
+        return message 
@@ -1,16 +1,71 @@
-import json
+import logging
 import os
+import sqlite3
+import orjson
 from datetime import datetime
 from typing import List, Dict, Optional, Any
 import shortuuid
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
 # Configuration
 BASE_DIR = os.getenv('BASE_DIR', os.path.join(os.path.dirname(__file__), 'data'))
 
+# Generador de los IDs cortos de notas, entradas, ideas y proyectos
+_SU = shortuuid.ShortUUID()
+
+def short_title(text: str, length: int = 30) -> str:
+    """Obtiene un título corto para una nota (primeros caracteres de su contenido)"""
+    return text if len(text) <= length else text[:length] + "…"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS notes (
+    id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    title TEXT,
+    created TEXT NOT NULL,
+    project_id TEXT,
+    updated TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_notes_project ON notes(project_id);
+CREATE INDEX IF NOT EXISTS ix_notes_created ON notes(created DESC);
+
+CREATE TABLE IF NOT EXISTS note_tags (
+    note_id TEXT NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+    tag TEXT NOT NULL,
+    PRIMARY KEY (note_id, tag)
+);
+CREATE INDEX IF NOT EXISTS ix_note_tags_tag ON note_tags(tag);
+
+CREATE TABLE IF NOT EXISTS journal (
+    id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_journal_created ON journal(created DESC);
+
+CREATE TABLE IF NOT EXISTS ideas (
+    id TEXT PRIMARY KEY,
+    content TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_ideas_created ON ideas(created DESC);
+
+CREATE TABLE IF NOT EXISTS projects (
+    id TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    created TEXT NOT NULL
+);
+"""
+
+# Las etiquetas de cada nota se devuelven en la misma consulta, como un array JSON
+NOTE_COLUMNS = """id, content, title, created, project_id, updated,
+    (SELECT json_group_array(tag) FROM (SELECT tag FROM note_tags WHERE note_id = notes.id ORDER BY rowid)) AS tags"""
+
 class NoteManager:
     """Gestor de notas, diario, ideas y proyectos"""
     
@@ -26,21 +81,23 @@ class NoteManager:
         self.analysis_dir = os.path.join(base_dir, "analysis")
         self.refined_dir = os.path.join(base_dir, "refined")
         
-        # Archivo JSON para almacenar metadatos
-        self.notes_file = os.path.join(base_dir, "notes.json")
+        # Base de datos con notas, diario, ideas y proyectos
+        self.db_file = os.path.join(base_dir, "notes.db")
+        
+        # Archivos JSON de versiones anteriores, que se importan a la base de datos.
+        # notes.json y projects.json no se tocan: el bot (assistent.py) los sigue usando
         self.journal_file = os.path.join(base_dir, "journal.json")
         self.ideas_file = os.path.join(base_dir, "ideas.json")
-        self.projects_file = os.path.join(base_dir, "projects.json")
         self.refined_file = os.path.join(base_dir, "refined.json")
         
         # Asegurar que existan los directorios necesarios
         self._ensure_directories()
         
-        # Cargar datos existentes
-        self.notes = self._load_json(self.notes_file)
-        self.journal = self._load_json(self.journal_file)
-        self.ideas = self._load_json(self.ideas_file)
-        self.projects = self._load_json(self.projects_file)
+        self._conn = self._connect()
+        self._migrate_json_files()
+        
+        # Los proyectos son pocos y se listan en cada menú, así que se guardan en memoria
+        self.projects = self._load_projects()
     
     def _ensure_directories(self):
         """Asegura que existan los directorios necesarios"""
@@ -52,149 +109,164 @@ class NoteManager:
         os.makedirs(self.analysis_dir, exist_ok=True)
         os.makedirs(self.refined_dir, exist_ok=True)
     
-    def _load_json(self, file_path: str) -> List[Dict]:
-        """Carga un archivo JSON"""
+    def _connect(self) -> sqlite3.Connection:
+        """Abre la base de datos y crea las tablas que falten"""
+        conn = sqlite3.connect(self.db_file, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        
+        # WAL deja leer mientras otro escribe; NORMAL basta para no corromper la base con WAL
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        conn.executescript(SCHEMA)
+        return conn
+    
+    def _load_json(self, file_path: str) -> Optional[List[Dict]]:
+        """Carga un archivo JSON; devuelve None si existe pero no se puede leer"""
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error al cargar {file_path}: {str(e)}")
+            with open(file_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
             return []
+        except Exception:
+            logger.error("Error al cargar %s", file_path, exc_info=True)
+            return None
     
-    def _save_json(self, file_path: str, data: List[Dict]):
-        """Guarda datos en un archivo JSON"""
-        try:
-            with open(file_path, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"Error al guardar {file_path}: {str(e)}")
+    def _migrate_json_files(self):
+        """Importa los archivos JSON de versiones anteriores y los elimina"""
+        # Un archivo que no se pudo leer se deja en su sitio para no perder su contenido
+        for file_path, table in ((self.journal_file, 'journal'), (self.ideas_file, 'ideas')):
+            items = self._load_json(file_path) if os.path.exists(file_path) else None
+            if items is not None:
+                with self._conn:
+                    self._conn.executemany(
+                        f"INSERT OR IGNORE INTO {table} (id, content, created) VALUES (?, ?, ?)",
+                        [(item['id'], item['content'], item['created']) for item in items]
+                    )
+                os.remove(file_path)
+    
+    def _note_from_row(self, row: sqlite3.Row) -> Dict[str, Any]:
+        """Convierte una fila de la tabla notes en una nota"""
+        note = {
+            'id': row['id'],
+            'content': row['content'],
+            'title': row['title'],
+            'created': row['created'],
+            'project_id': row['project_id'],
+            'tags': orjson.loads(row['tags'])
+        }
+        if row['updated'] is not None:
+            note['updated'] = row['updated']
+        return note
+    
+    def _query_notes(self, where: str = "", params: tuple = (), order: str = "rowid", limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Obtiene las notas que cumplen una condición"""
+        sql = f"SELECT {NOTE_COLUMNS} FROM notes {where} ORDER BY {order}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params = params + (limit,)
+        return [self._note_from_row(row) for row in self._conn.execute(sql, params)]
     
     def create_note(self, content: str, project_id: Optional[str] = None) -> Dict[str, Any]:
         """Crea una nueva nota"""
         # Generar ID corto
-        note_id = shortuuid.uuid()[:8]
+        note_id = _SU.random(length=8)
         
         # Crear la nota
         note = {
             'id': note_id,
             'content': content,
+            'title': short_title(content),
             'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
-            'project_id': project_id
+            'project_id': project_id,
+            'tags': []
         }
         
-        # Cargar notas existentes
-        notes = self._load_json(self.notes_file)
-        
-        # Agregar la nueva nota
-        notes.append(note)
-        
-        # Guardar notas
-        self._save_json(self.notes_file, notes)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO notes (id, content, title, created, project_id) VALUES (?, ?, ?, ?, ?)",
+                (note_id, content, note['title'], note['created'], project_id)
+            )
         
         return note
     
     def get_note(self, note_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene una nota por su ID"""
-        notes = self._load_json(self.notes_file)
-        for note in notes:
-            if note['id'] == note_id:
-                return note
-        return None
+        notes = self._query_notes("WHERE id = ?", (note_id,))
+        return notes[0] if notes else None
     
     def get_notes(self, project_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """Obtiene todas las notas o las de un proyecto específico"""
-        notes = self._load_json(self.notes_file)
         if project_id:
-            return [note for note in notes if note.get('project_id') == project_id]
-        return notes
+            return self.get_notes_by_project(project_id)
+        return self._query_notes()
+    
+    def get_notes_by_project(self, project_id: str) -> List[Dict[str, Any]]:
+        """Obtiene las notas de un proyecto"""
+        return self._query_notes("WHERE project_id = ?", (project_id,))
     
     def get_recent_notes(self, limit: int = 5) -> List[Dict[str, Any]]:
         """Obtiene las notas más recientes"""
-        notes = self._load_json(self.notes_file)
-        # Ordenar por fecha de creación (más recientes primero)
-        notes.sort(key=lambda x: x['created'], reverse=True)
-        return notes[:limit]
+        return self._query_notes(order="created DESC, rowid DESC", limit=limit)
     
-    def create_journal_entry(self, content: str) -> Dict[str, Any]:
-        """Crea una nueva entrada de diario"""
+    def _create_entry(self, table: str, content: str) -> Dict[str, Any]:
+        """Crea una entrada de diario o una idea"""
         # Generar ID corto
-        entry_id = shortuuid.uuid()[:8]
-        
-        # Crear la entrada
         entry = {
-            'id': entry_id,
+            'id': _SU.random(length=8),
             'content': content,
             'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         
-        # Cargar entradas existentes
-        entries = self._load_json(self.journal_file)
-        
-        # Agregar la nueva entrada
-        entries.append(entry)
-        
-        # Guardar entradas
-        self._save_json(self.journal_file, entries)
+        with self._conn:
+            self._conn.execute(
+                f"INSERT INTO {table} (id, content, created) VALUES (?, ?, ?)",
+                (entry['id'], entry['content'], entry['created'])
+            )
         
         return entry
     
+    def _get_entry(self, table: str, entry_id: str) -> Optional[Dict[str, Any]]:
+        """Obtiene una entrada de diario o una idea por su ID"""
+        row = self._conn.execute(f"SELECT id, content, created FROM {table} WHERE id = ?", (entry_id,)).fetchone()
+        return dict(row) if row else None
+    
+    def _get_recent_entries(self, table: str, limit: int) -> List[Dict[str, Any]]:
+        """Obtiene las entradas de diario o ideas más recientes"""
+        rows = self._conn.execute(
+            f"SELECT id, content, created FROM {table} ORDER BY created DESC, rowid DESC LIMIT ?",
+            (limit,)
+        )
+        return [dict(row) for row in rows]
+    
+    def create_journal_entry(self, content: str) -> Dict[str, Any]:
+        """Crea una nueva entrada de diario"""
+        return self._create_entry('journal', content)
+    
     def get_journal_entry(self, entry_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene una entrada de diario por su ID"""
-        entries = self._load_json(self.journal_file)
-        for entry in entries:
-            if entry['id'] == entry_id:
-                return entry
-        return None
+        return self._get_entry('journal', entry_id)
     
     def get_recent_journal_entries(self, limit: int = 5) -> List[Dict[str, Any]]:
         """Obtiene las entradas de diario más recientes"""
-        entries = self._load_json(self.journal_file)
-        # Ordenar por fecha de creación (más recientes primero)
-        entries.sort(key=lambda x: x['created'], reverse=True)
-        return entries[:limit]
+        return self._get_recent_entries('journal', limit)
     
     def create_idea(self, content: str) -> Dict[str, Any]:
         """Crea una nueva idea"""
-        # Generar ID corto
-        idea_id = shortuuid.uuid()[:8]
-        
-        # Crear la idea
-        idea = {
-            'id': idea_id,
-            'content': content,
-            'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        }
-        
-        # Cargar ideas existentes
-        ideas = self._load_json(self.ideas_file)
-        
-        # Agregar la nueva idea
-        ideas.append(idea)
-        
-        # Guardar ideas
-        self._save_json(self.ideas_file, ideas)
-        
-        return idea
+        return self._create_entry('ideas', content)
     
     def get_idea(self, idea_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene una idea por su ID"""
-        ideas = self._load_json(self.ideas_file)
-        for idea in ideas:
-            if idea['id'] == idea_id:
-                return idea
-        return None
+        return self._get_entry('ideas', idea_id)
     
     def get_recent_ideas(self, limit: int = 5) -> List[Dict[str, Any]]:
         """Obtiene las ideas más recientes"""
-        ideas = self._load_json(self.ideas_file)
-        # Ordenar por fecha de creación (más recientes primero)
-        ideas.sort(key=lambda x: x['created'], reverse=True)
-        return ideas[:limit]
+        return self._get_recent_entries('ideas', limit)
     
     def create_project(self, title: str) -> Dict[str, Any]:
         """Crea un nuevo proyecto"""
         # Generar ID corto
-        project_id = shortuuid.uuid()[:8]
+        project_id = _SU.random(length=8)
         
         # Crear el proyecto
         project = {
@@ -203,28 +275,29 @@ class NoteManager:
             'created': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         }
         
-        # Cargar proyectos existentes
-        projects = self._load_json(self.projects_file)
-        
-        # Agregar el nuevo proyecto
-        projects.append(project)
-        
-        # Guardar proyectos
-        self._save_json(self.projects_file, projects)
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO projects (id, title, created) VALUES (?, ?, ?)",
+                (project_id, title, project['created'])
+            )
+        self.projects.append(project)
+        self._projects_by_id[project_id] = project
         
         return project
     
     def get_project(self, project_id: str) -> Optional[Dict[str, Any]]:
         """Obtiene un proyecto por su ID"""
-        projects = self._load_json(self.projects_file)
-        for project in projects:
-            if project['id'] == project_id:
-                return project
-        return None
+        return self._projects_by_id.get(project_id)
     
     def get_projects(self) -> List[Dict[str, Any]]:
         """Obtiene todos los proyectos"""
-        return self._load_json(self.projects_file)
+        return self.projects
+    
+    def _load_projects(self) -> List[Dict[str, Any]]:
+        """Lee los proyectos de la base de datos"""
+        projects = [dict(row) for row in self._conn.execute("SELECT id, title, created FROM projects ORDER BY rowid")]
+        self._projects_by_id = {project['id']: project for project in projects}
+        return projects
     
     def save_analysis(self, note_id: str, analysis: str):
         """Guarda un análisis de una nota"""
@@ -237,37 +310,33 @@ class NoteManager:
     
     def update_note(self, note_id: str, content: str) -> bool:
         """Actualiza el contenido de una nota"""
-        notes = self._load_json(self.notes_file)
-        for note in notes:
-            if note['id'] == note_id:
-                note['content'] = content
-                note['updated'] = datetime.now().strftime("%Y-%m-%d %H:%M")
-                self._save_json(self.notes_file, notes)
-                return True
-        return False
+        with self._conn:
+            cursor = self._conn.execute(
+                "UPDATE notes SET content = ?, title = ?, updated = ? WHERE id = ?",
+                (content, short_title(content), datetime.now().strftime("%Y-%m-%d %H:%M"), note_id)
+            )
+        return cursor.rowcount > 0
     
     def delete_note(self, note_id: str) -> bool:
         """Elimina una nota"""
-        notes = self._load_json(self.notes_file)
-        for i, note in enumerate(notes):
-            if note['id'] == note_id:
-                notes.pop(i)
-                self._save_json(self.notes_file, notes)
-                return True
-        return False
+        # Sus etiquetas se borran con ella (ON DELETE CASCADE)
+        with self._conn:
+            cursor = self._conn.execute("DELETE FROM notes WHERE id = ?", (note_id,))
+        return cursor.rowcount > 0
     
     def add_tag(self, note_id: str, tag: str) -> bool:
         """Añade una etiqueta a una nota"""
-        notes = self._load_json(self.notes_file)
-        for note in notes:
-            if note['id'] == note_id:
-                if tag not in note['tags']:
-                    note['tags'].append(tag)
-                    self._save_json(self.notes_file, notes)
-                return True
-        return False
+        if self._conn.execute("SELECT 1 FROM notes WHERE id = ?", (note_id,)).fetchone() is None:
+            return False
+        
+        with self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO note_tags (note_id, tag) VALUES (?, ?)", (note_id, tag))
+        return True
     
     def get_notes_by_tag(self, tag: str) -> List[Dict]:
         """Obtiene todas las notas con una etiqueta específica"""
-        notes = self._load_json(self.notes_file)
-        return [note for note in notes if tag in note.get('tags', [])] 
\ No newline at end of file
+        return self._query_notes("WHERE id IN (SELECT note_id FROM note_tags WHERE tag = ?)", (tag,))
+    
+    def close(self):
+        """Cierra la base de datos"""
+        self._conn.close()
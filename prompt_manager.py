@@ -1,9 +1,12 @@
-import json
+import logging
 import os
+import orjson
 from typing import Dict, Optional
 from datetime import datetime
 from dotenv import load_dotenv
 
+logger = logging.getLogger(__name__)
+
 # Load environment variables
 load_dotenv()
 
@@ -26,25 +29,33 @@ class PromptManager:
         
         # Initialize JSON file if it doesn't exist
         if not os.path.exists(self.prompts_file):
-            with open(self.prompts_file, 'w', encoding='utf-8') as f:
-                json.dump([], f)
+            with open(self.prompts_file, 'wb') as f:
+                f.write(orjson.dumps([]))
         
         # Prompt and context files
         self.base_prompt_file = os.path.join(self.prompts_dir, "base_prompt.json")
         self.context_file = os.path.join(self.prompts_dir, "context.json")
         
         # Load base prompt and context
-        self.base_prompt = self._load_json(self.base_prompt_file)
-        self.context = self._load_json(self.context_file)
+        self.base_prompt = self._load_json(self.base_prompt_file, self._get_default_base_prompt())
+        self.context = self._load_json(self.context_file, {})
+        
+        # Complete prompt, rebuilt only after the base prompt or the context change
+        self._complete_prompt_cache: Optional[str] = None
     
     def _ensure_directories(self):
         """Ensures that necessary directories exist"""
         os.makedirs(self.prompts_dir, exist_ok=True)
     
-    def _load_json(self, file_path: str) -> Dict:
-        """Loads a JSON file"""
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
+    def _load_json(self, file_path: str, default: Dict) -> Dict:
+        """Loads a JSON file, creating it with the default content on first boot"""
+        try:
+            with open(file_path, 'rb') as f:
+                return orjson.loads(f.read())
+        except FileNotFoundError:
+            with open(file_path, 'wb') as f:
+                f.write(orjson.dumps(default, option=orjson.OPT_INDENT_2))
+            return default
     
     def get_prompt(self, additional_context: Optional[Dict] = None) -> Dict:
         """Gets the complete prompt with current context"""
@@ -61,33 +72,36 @@ class PromptManager:
         """Updates the base prompt content"""
         try:
             self.base_prompt["content"] = new_content
-            with open(self.base_prompt_file, 'w', encoding='utf-8') as f:
-                json.dump(self.base_prompt, f, ensure_ascii=False, indent=2)
+            self._complete_prompt_cache = None
+            with open(self.base_prompt_file, 'wb') as f:
+                f.write(orjson.dumps(self.base_prompt, option=orjson.OPT_INDENT_2))
             return True
         except Exception as e:
-            print(f"Error updating base prompt: {str(e)}")
+            logger.error("Error updating base prompt: %s", e)
             return False
     
     def set_context(self, key: str, value: any) -> bool:
         """Sets a value in the context"""
         try:
             self.context[key] = value
-            with open(self.context_file, 'w', encoding='utf-8') as f:
-                json.dump(self.context, f, ensure_ascii=False, indent=2)
+            self._complete_prompt_cache = None
+            with open(self.context_file, 'wb') as f:
+                f.write(orjson.dumps(self.context, option=orjson.OPT_INDENT_2))
             return True
         except Exception as e:
-            print(f"Error updating context: {str(e)}")
+            logger.error("Error updating context: %s", e)
             return False
     
     def clear_context(self) -> bool:
         """Clears the current context"""
         try:
             self.context = {}
-            with open(self.context_file, 'w', encoding='utf-8') as f:
-                json.dump(self.context, f, ensure_ascii=False, indent=2)
+            self._complete_prompt_cache = None
+            with open(self.context_file, 'wb') as f:
+                f.write(orjson.dumps(self.context, option=orjson.OPT_INDENT_2))
             return True
         except Exception as e:
-            print(f"Error clearing context: {str(e)}")
+            logger.error("Error clearing context: %s", e)
             return False
     
     def _get_default_base_prompt(self) -> Dict:
@@ -128,24 +142,28 @@ Remember:
 
     def get_complete_prompt(self) -> str:
         """Gets the complete prompt with current context"""
+        if self._complete_prompt_cache is not None:
+            return self._complete_prompt_cache
+        
         try:
             # Load base prompt
-            with open(self.base_prompt_file, 'r', encoding='utf-8') as f:
-                base_prompt = json.load(f)
+            with open(self.base_prompt_file, 'rb') as f:
+                base_prompt = orjson.loads(f.read())
             
             # Load context
-            with open(self.context_file, 'r', encoding='utf-8') as f:
-                context = json.load(f)
+            with open(self.context_file, 'rb') as f:
+                context = orjson.loads(f.read())
             
             # Format base prompt with context
             complete_prompt = base_prompt['content'].format(
-                context=json.dumps(context, indent=2, ensure_ascii=False)
+                context=orjson.dumps(context, option=orjson.OPT_INDENT_2).decode()
             )
             
+            self._complete_prompt_cache = complete_prompt
             return complete_prompt
             
         except Exception as e:
-            logger.error(f"Error getting complete prompt: {str(e)}")
+            logger.error("Error getting complete prompt: %s", e)
             # In case of error, return a basic prompt
             return """You are an intelligent and friendly personal assistant.
 Respond naturally and helpfully to the user.